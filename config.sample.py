@@ -4,3 +4,34 @@
 server_url = "http://127.0.0.1:5000"
 db_uri = "sqlite:///test.db"
 debug = True
+
+#Addresses of the reverse proxies allowed to set X-Forwarded-For. Required
+#whenever the server runs behind a proxy: otherwise every client is seen
+#with the proxy address and all of them share the same rate limits.
+#trusted_proxies = ["127.0.0.1"]
+
+#Rate limiting, in requests per second and burst size for each budget.
+#rate_limits = {
+#    'address': (10, 50),
+#    'device': (1/5, 3),
+#    'oauth': (1/10, 5),
+#    'scrobble': (1, 10),
+#    'catch_all': (1/5, 5),
+#    'default': (5, 20),
+#}
+#rate_limit_max_clients = 10000
+
+#Load shedding: reject requests while more than shed_max_writes write
+#requests are in flight or while average latency exceeds shed_max_latency
+#seconds. The average halves every shed_half_life seconds without traffic.
+#shed_max_writes = 16
+#shed_max_latency = 2.
+#shed_half_life = 5.
+#shed_retry_after = 5
+
+#Invalidation bus keeping caches coherent between several instances:
+#local:// for a single instance, multicast://239.255.0.1:5007 or
+#redis://[:password@]127.0.0.1:6379 when running behind a shared reverse
+#proxy. Cached entries also expire after cache_ttl seconds.
+#invalidation_bus = "local://"
+#cache_ttl = 60
@@ -0,0 +1,357 @@
+import logging
+import socket
+import struct
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit, unquote
+
+'''
+Cache invalidation bus
+
+Lets several trackt-server instances keep their in-process caches coherent.
+Write paths publish an invalidation as a (channel, key) pair, e.g.
+('token', access_token) or ('user', user_id), and every node, the
+publisher included, calls its subscribers with it. When a node may have
+missed messages, after its bus connection was lost, subscribers are called
+with the ALL channel and must drop everything.
+
+Backends are selected by URL:
+    local://                      in-process only (single node)
+    multicast://239.255.0.1:5007  UDP multicast on the local network
+    redis://[[user]:password@]127.0.0.1:6379[/db]
+                                  Redis PUBLISH / SUBSCRIBE, the database
+                                  number is ignored as channels are shared
+                                  by all databases
+'''
+
+log = logging.getLogger(__name__)
+
+ALL = '*'
+
+class InvalidationBus(object):
+    '''
+    In-process bus, base class of the other backends
+
+    Backends implement send() to reach the other nodes, and connect() which
+    opens the listening side and returns the function receiving from it.
+    '''
+    min_delay = .5
+    max_delay = 30.
+
+    def __init__(self):
+        self.node = uuid.uuid4().hex
+        self.subscribers = []
+        self.ready = threading.Event()
+        self.closed = threading.Event()
+        self.listener = None
+
+    def subscribe(self, callback):
+        '''callback(channel, key) is called for every invalidation'''
+        self.subscribers.append(callback)
+
+    def publish(self, channel, key):
+        '''
+        Invalidate on this node, then on the others. Failing to reach the
+        other nodes is only logged: the write being published is already
+        committed and must not fail because of the bus.
+        '''
+        key = str(key)
+        self.dispatch(channel, key)
+        try:
+            self.send(channel, key)
+        except (OSError, ConnectionError) as e:
+            log.warning('Could not publish invalidation of %s %s: %s', channel, key, e)
+
+    def send(self, channel, key):
+        pass
+
+    def close(self):
+        '''Stop listening'''
+        self.closed.set()
+        listener = self.listener
+        if listener is not None:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def dispatch(self, channel, key):
+        for callback in self.subscribers:
+            callback(channel, key)
+
+    def encode(self, channel, key):
+        return ('%s %s %s' % (self.node, channel, key)).encode('utf-8')
+
+    def receive(self, payload):
+        '''Dispatch a message from another node, ignoring our own'''
+        try:
+            node, channel, key = payload.decode('utf-8').split(' ', 2)
+        except ValueError:
+            return
+        if node != self.node:
+            self.dispatch(channel, key)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.follow, name='invalidation-bus')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def follow(self):
+        '''Listen forever, reconnecting with an exponential backoff'''
+        delay = self.min_delay
+        while not self.closed.is_set():
+            try:
+                listen = self.connect()
+                # Anything published while we were not listening is lost
+                self.dispatch(ALL, None)
+                self.ready.set()
+                delay = self.min_delay
+                listen()
+            except (OSError, ConnectionError) as e:
+                if self.closed.is_set():
+                    break
+                log.warning('Invalidation bus connection lost: %s, retrying in %.1fs', e, delay)
+            self.ready.clear()
+            self.closed.wait(delay)
+            delay = min(delay * 2, self.max_delay)
+        self.ready.clear()
+
+class MulticastBus(InvalidationBus):
+    '''
+    Send invalidations as UDP multicast datagrams
+
+    Messages are fire and forget: a lost datagram leaves a stale entry
+    on one node, so caches using this backend should keep a short TTL.
+    '''
+    def __init__(self, group='239.255.0.1', port=5007, ttl=1):
+        super(MulticastBus, self).__init__()
+        self.group = group
+        self.port = port
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.start()
+
+    def send(self, channel, key):
+        self.sender.sendto(self.encode(channel, key), (self.group, self.port))
+
+    def close(self):
+        super(MulticastBus, self).close()
+        # Shutting a datagram socket down does not wake recvfrom up
+        try:
+            self.sender.sendto(b'', (self.group, self.port))
+        except OSError:
+            pass
+        self.sender.close()
+
+    def connect(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(('', self.port))
+            membership = struct.pack('4sl', socket.inet_aton(self.group), socket.INADDR_ANY)
+            listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            listener.close()
+            raise
+
+        self.listener = listener
+
+        def listen():
+            with listener:
+                while not self.closed.is_set():
+                    payload, address = listener.recvfrom(4096)
+                    self.receive(payload)
+        return listen
+
+class RedisBus(InvalidationBus):
+    '''
+    Send invalidations through Redis PUBLISH / SUBSCRIBE
+
+    Speaks the Redis protocol directly so no client library is needed, any
+    server implementing AUTH, PUBLISH and SUBSCRIBE will do. Nothing is
+    connected in the constructor, so the server starts while Redis is
+    unreachable; wait on `ready` to know the subscription is active.
+
+    :param timeout: connect and publish timeout, in seconds
+    '''
+    def __init__(self, host='127.0.0.1', port=6379, username=None, password=None,
+                 channel='trackt:invalidate', timeout=1.):
+        super(RedisBus, self).__init__()
+        self.address = (host, port)
+        self.username = username
+        self.password = password
+        self.channel = channel
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connection = None
+        self.down_until = 0
+        self.start()
+
+    @staticmethod
+    def command(*args):
+        result = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            result.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(result)
+
+    @classmethod
+    def read_reply(cls, stream):
+        line = stream.readline()
+        if not line:
+            raise ConnectionError('Redis connection closed')
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value
+        if kind == b'-':
+            raise ConnectionError(value.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if int(value) < 0:
+                return None
+            data = stream.read(int(value) + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [cls.read_reply(stream) for i in range(int(value))]
+        raise ConnectionError('Unexpected Redis reply %r' % line)
+
+    def open(self):
+        '''Connect and authenticate, return the socket and its stream'''
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        stream = sock.makefile('rwb')
+        try:
+            if self.password is not None:
+                credentials = [self.username, self.password] if self.username else [self.password]
+                stream.write(self.command(b'AUTH', *[c.encode('utf-8') for c in credentials]))
+                stream.flush()
+                self.read_reply(stream)
+        except (OSError, ConnectionError):
+            stream.close()
+            sock.close()
+            raise
+        return sock, stream
+
+    def close(self):
+        super(RedisBus, self).close()
+        with self.lock:
+            if self.connection is not None:
+                self.connection[1].close()
+                self.connection[0].close()
+                self.connection = None
+
+    def send(self, channel, key):
+        message = self.command(b'PUBLISH', self.channel.encode('utf-8'), self.encode(channel, key))
+        with self.lock:
+            if time.monotonic() < self.down_until:
+                raise ConnectionError('Redis unavailable, not retrying yet')
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connection = self.open()
+                    sock, stream = self.connection
+                    stream.write(message)
+                    stream.flush()
+                    return self.read_reply(stream)
+                except (OSError, ConnectionError):
+                    if self.connection is not None:
+                        self.connection[1].close()
+                        self.connection[0].close()
+                        self.connection = None
+                    if attempt:
+                        # Don't make every write wait for the timeout again
+                        self.down_until = time.monotonic() + self.min_delay
+                        raise
+
+    def connect(self):
+        sock, stream = self.open()
+        try:
+            stream.write(self.command(b'SUBSCRIBE', self.channel.encode('utf-8')))
+            stream.flush()
+            self.read_reply(stream)
+            # Wait for messages as long as needed, keepalive notices dead peers
+            sock.settimeout(None)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except (OSError, ConnectionError):
+            stream.close()
+            sock.close()
+            raise
+        self.listener = sock
+
+        def listen():
+            with sock, stream:
+                while True:
+                    reply = self.read_reply(stream)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                        self.receive(reply[2])
+        return listen
+
+def from_url(url):
+    '''Build a bus from a local://, multicast:// or redis:// url'''
+    parts = urlsplit(url)
+    if parts.query or parts.fragment:
+        raise ValueError('Unexpected query in invalidation bus %s' % url)
+    if parts.scheme == 'local':
+        return InvalidationBus()
+    if parts.scheme == 'multicast':
+        if parts.path.strip('/') or parts.username or parts.password:
+            raise ValueError('Unexpected path or credentials in invalidation bus %s' % url)
+        return MulticastBus(group=parts.hostname or '239.255.0.1', port=parts.port or 5007)
+    if parts.scheme == 'redis':
+        database = parts.path.strip('/')
+        if database and not database.isdigit():
+            raise ValueError('Invalid database number in invalidation bus %s' % url)
+        return RedisBus(host=parts.hostname or '127.0.0.1', port=parts.port or 6379,
+                        username=unquote(parts.username) if parts.username else None,
+                        password=unquote(parts.password) if parts.password is not None else None)
+    raise ValueError('Unknown invalidation bus %s' % url)
+
+class Cache(object):
+    '''
+    Small in-process cache dropped entry by entry through a bus
+
+    Entries also expire after `ttl` seconds, bounding staleness when an
+    invalidation is lost.
+
+    :param bus: the invalidation bus to listen on
+    :param channel: invalidations on this channel remove the matching key
+    '''
+    def __init__(self, bus, channel, ttl=60, max_size=10000, clock=time.monotonic):
+        self.channel = channel
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.data = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        bus.subscribe(self.invalidate)
+
+    def get(self, key):
+        entry = self.data.get(str(key))
+        if entry is not None and entry[1] > self.clock():
+            return entry[0]
+        return None
+
+    def set(self, key, value, generation=None):
+        '''
+        Store a value, unless an invalidation happened since `generation`
+        was read: the value may have been computed from stale data.
+        '''
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if len(self.data) >= self.max_size:
+                self.data.clear()
+            self.data[str(key)] = (value, self.clock() + self.ttl)
+
+    def invalidate(self, channel, key):
+        if channel == ALL:
+            with self.lock:
+                self.generation += 1
+                self.data.clear()
+        elif channel == self.channel:
+            with self.lock:
+                self.generation += 1
+                self.data.pop(key, None)
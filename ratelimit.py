@@ -0,0 +1,119 @@
+import time
+import threading
+
+'''
+Token bucket rate limiting and load shedding
+
+Buckets live in memory only, keyed by (budget name, client key), so the
+checks below never touch the database.
+'''
+
+class TokenBucket(object):
+    '''A bucket refilled at `rate` tokens per second up to `burst` tokens'''
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now):
+        '''Take one token, return 0 on success or the seconds to wait otherwise'''
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter(object):
+    '''
+    Per key token buckets
+
+    :param budgets: dict of budget name to (rate per second, burst)
+    :param max_buckets: number of buckets kept before idle ones are dropped
+    '''
+    def __init__(self, budgets, max_buckets=10000, clock=time.monotonic):
+        self.budgets = budgets
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def hit(self, budget, key):
+        '''Account one request, return 0 if allowed or the seconds to wait'''
+        rate, burst = self.budgets[budget]
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.get((budget, key))
+            if bucket is None:
+                if len(self.buckets) >= self.max_buckets:
+                    self.prune(now)
+                bucket = self.buckets[(budget, key)] = TokenBucket(rate, burst, now)
+            return bucket.consume(now)
+
+    def prune(self, now):
+        '''
+        Drop buckets which have refilled, they are equivalent to new ones,
+        then the least recently used ones until the table is half empty so
+        the scan only runs once every max_buckets / 2 new clients.
+        '''
+        for key, bucket in list(self.buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst:
+                del self.buckets[key]
+        excess = len(self.buckets) - self.max_buckets // 2
+        if excess > 0:
+            for key, bucket in sorted(self.buckets.items(), key=lambda i: i[1].updated)[:excess]:
+                del self.buckets[key]
+
+class LoadShedder(object):
+    '''
+    Global overload detection
+
+    Tracks the number of in flight write requests (all of them wait on the
+    single SQLite writer) and an exponential moving average of request
+    latency. Once either passes its threshold new requests are shed.
+
+    Shed requests are not sampled, so the latency average also halves
+    every `half_life` seconds: an overloaded server recovers on its own.
+
+    :param max_writes: in flight write requests allowed
+    :param max_latency: average request latency allowed, in seconds
+    :param alpha: weight of the last sample in the latency average
+    :param half_life: seconds for the latency average to halve without samples
+    '''
+    def __init__(self, max_writes, max_latency, alpha=0.1, half_life=5., clock=time.monotonic):
+        self.max_writes = max_writes
+        self.max_latency = max_latency
+        self.alpha = alpha
+        self.half_life = half_life
+        self.clock = clock
+        self.writes = 0
+        self.latency = 0.
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def current_latency(self, now):
+        return self.latency * 0.5 ** ((now - self.updated) / self.half_life)
+
+    def overloaded(self):
+        return self.writes >= self.max_writes or self.current_latency(self.clock()) > self.max_latency
+
+    def start_write(self):
+        with self.lock:
+            self.writes += 1
+
+    def end_write(self):
+        with self.lock:
+            self.writes -= 1
+
+    def record(self, duration):
+        with self.lock:
+            now = self.clock()
+            self.latency = self.current_latency(now)
+            self.latency += self.alpha * (duration - self.latency)
+            self.updated = now
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, jsonify, request, render_template, g
 from models import *
 from core import db
 import config
 import pprint
+import math
+import time
+import uuid
 from functools import wraps
+from ratelimit import RateLimiter, LoadShedder
+import invalidation
 
 app = Flask(__name__)
 
@@ -24,10 +29,16 @@ class ReverseProxied(object):
         proxy_set_header X-Script-Name /myprefix;
         }
 
+    X-Forwarded-For is only trusted when the request comes from one of
+    the trusted proxies, otherwise any client could pick its address.
+
     :param app: the WSGI application
+    :param trusted_proxies: addresses of the front-end servers
     '''
-    def __init__(self, app):
+    def __init__(self, app, trusted_proxies=()):
         self.app = app
+        self.trusted_proxies = set(trusted_proxies)
+        self.warned = False
 
     def __call__(self, environ, start_response):
         script_name = environ.get('HTTP_X_SCRIPT_NAME', '')
@@ -37,11 +48,138 @@ class ReverseProxied(object):
             if path_info.startswith(script_name):
                 environ['PATH_INFO'] = path_info[len(script_name):]
 
+        forwarded_for = environ.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded_for and environ.get('REMOTE_ADDR') not in self.trusted_proxies and not self.warned:
+            # All clients behind an untrusted proxy share its rate limits
+            self.warned = True
+            app.logger.warning('Ignoring X-Forwarded-For from %s, add it to trusted_proxies if it is your reverse proxy',
+                               environ.get('REMOTE_ADDR'))
+        if forwarded_for and environ.get('REMOTE_ADDR') in self.trusted_proxies:
+            # Each proxy appends the address it received the request from,
+            # the client is the last one not added by a trusted proxy
+            for address in reversed([a.strip() for a in forwarded_for.split(',')]):
+                environ['REMOTE_ADDR'] = address
+                if address not in self.trusted_proxies:
+                    break
+
         scheme = environ.get('HTTP_X_SCHEME', '')
         if scheme:
             environ['wsgi.url_scheme'] = scheme
         return self.app(environ, start_response)
 
+'''
+Admission control
+    Every request is accounted in token buckets before any database work:
+    one per client address, then one for the route budget. The route bucket
+    is keyed by the access token on authenticated routes and by the device
+    code while polling for authorization, as long as they look like tokens
+    we issue, and by the client address otherwise. A request over budget
+    gets a 429, and every request gets a 503 while the server is overloaded.
+'''
+rate_limits = getattr(config, 'rate_limits', {
+    # budget: (requests per second, burst)
+    'address': (10, 50),
+    'device': (1/5, 3),
+    'oauth': (1/10, 5),
+    'scrobble': (1, 10),
+    'catch_all': (1/5, 5),
+    'default': (5, 20),
+})
+endpoint_budgets = {
+    'device_token': 'device',
+    'code': 'oauth',
+    'refresh_token': 'oauth',
+    'post_register': 'oauth',
+    'scrobble': 'scrobble',
+    'catch_all': 'catch_all',
+}
+limiter = RateLimiter(rate_limits, max_buckets=getattr(config, 'rate_limit_max_clients', 10000))
+shedder = LoadShedder(max_writes=getattr(config, 'shed_max_writes', 16),
+                      max_latency=getattr(config, 'shed_max_latency', 2.),
+                      half_life=getattr(config, 'shed_half_life', 5.))
+
+def well_formed(token):
+    try:
+        return str(uuid.UUID(token)) == token
+    except (TypeError, ValueError):
+        return False
+
+def client_key(address):
+    view = app.view_functions.get(request.endpoint)
+    if getattr(view, 'authenticated', False):
+        authorization = request.headers.get('Authorization', '').split(" ")
+        if len(authorization) == 2 and well_formed(authorization[1]):
+            return 'token:' + authorization[1]
+    if request.endpoint == 'device_token':
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and well_formed(body.get('code')):
+            return 'code:' + body['code']
+    return address
+
+@app.before_request
+def admission_control():
+    if shedder.overloaded():
+        app.logger.warn('Overloaded, shedding request on %s', request.path)
+        return jsonify({}), 503, {'Retry-After': str(getattr(config, 'shed_retry_after', 5))}
+    address = 'ip:' + str(request.remote_addr)
+    budget = 'address'
+    wait = limiter.hit(budget, address)
+    if not wait:
+        budget = endpoint_budgets.get(request.endpoint, 'default')
+        wait = limiter.hit(budget, client_key(address))
+    if wait:
+        app.logger.info('Rate limit reached for %s on %s', budget, request.path)
+        return jsonify({}), 429, {'Retry-After': str(int(math.ceil(wait)))}
+    g.started_at = time.monotonic()
+    if request.method == 'POST':
+        g.write = True
+        shedder.start_write()
+
+@app.teardown_request
+def admission_done(exception=None):
+    if g.pop('write', False):
+        shedder.end_write()
+    if 'started_at' in g:
+        shedder.record(time.monotonic() - g.started_at)
+
+'''
+Cache coherence
+    Cached state is dropped through the invalidation bus once a write is
+    committed, so every node behind the reverse proxy sees it. Publish on
+    the 'token' channel with the old access token when a token changes, and
+    on the 'user' channel with the user id when a user's content changes.
+
+    token_cache maps access tokens to their user id, the other caches hold
+    rendered sync responses by user id.
+'''
+bus = invalidation.from_url(getattr(config, 'invalidation_bus', 'local://'))
+cache_ttl = getattr(config, 'cache_ttl', 60)
+token_cache = invalidation.Cache(bus, 'token', ttl=cache_ttl)
+watched_cache = invalidation.Cache(bus, 'user', ttl=cache_ttl)
+playback_cache = invalidation.Cache(bus, 'user', ttl=cache_ttl)
+
+def cached_per_user(cache):
+    '''
+    Serve a rendered response from cache without any database work when
+    the access token is known. Wraps a view decorated with required_roles.
+    '''
+    def wrapper(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            authorization = request.headers.get('Authorization', '').split(" ")[-1]
+            user_id = token_cache.get(authorization)
+            body = cache.get(user_id) if user_id is not None else None
+            if body is not None:
+                return app.response_class(body, mimetype='application/json')
+            generation = cache.generation
+            response = f(*args, **kwargs)
+            user_id = token_cache.get(authorization)
+            if user_id is not None and isinstance(response, app.response_class) and response.status_code == 200:
+                cache.set(user_id, response.get_data(), generation)
+            return response
+        return wrapped
+    return wrapper
+
 def required_roles():
     def wrapper(f):
         @wraps(f)
@@ -49,12 +187,16 @@ def required_roles():
             try:
                 print(request.headers.get('Authorization'))
                 authorization = request.headers.get('Authorization').split(" ")[1]
+                generation = token_cache.generation
                 user_token = Token.query.filter_by(access_token=authorization).first()
                 if not user_token:
                     raise Exception
+                if user_token.user_id is not None:
+                    token_cache.set(authorization, user_token.user_id, generation)
             except:
                 return "", 403
             return f(user_token, *args, **kwargs)
+        wrapped.authenticated = True
         return wrapped
     return wrapper
 @app.route('/register')
@@ -68,6 +210,8 @@ def post_register():
         user_token.user = addUser(username=request.form['username'])
         db.session.add(user_token)
         db.session.commit()
+        # The user code can bind an already used token to another user
+        bus.publish('token', user_token.access_token)
         return "OK"
     else:
         return "Unknown user code"
@@ -131,9 +275,11 @@ def device_token():
     token = Token.query.filter_by(access_token=request.json['code']).first()
     if token:
         if token.user:
+            old_access_token = token.access_token
             token.renew()
             db.session.add(token)
             db.session.commit()
+            bus.publish('token', old_access_token)
             return jsonify({
               "access_token": token.access_token,
               "token_type": "bearer",
@@ -173,9 +319,11 @@ Response:
 @required_roles()
 def refresh_token(user_token):
     app.logger.debug('Received refresh token request')
+    old_access_token = user_token.access_token
     user_token.renew()
     db.session.add(user_token)
     db.session.commit()
+    bus.publish('token', old_access_token)
     return jsonify({
       "access_token": user_token.access_token,
       "token_type": "bearer",
@@ -228,6 +376,7 @@ def scrobble(user_token):
         addEpisode(user=user_token.user, json_request=request.json['episode'], show=show, progress=request.json.get('progress', None))
         app.logger.debug('Save progres')
         db.session.commit()
+        bus.publish('user', user_token.user.id)
     else:
         app.logger.warn('Scrobble request without episode data')
         raise NotImplemented
@@ -268,6 +417,7 @@ Response:
     ]
 '''
 @app.route('/sync/watched/shows')
+@cached_per_user(watched_cache)
 @required_roles()
 def watched_shows(user_token):
     app.logger.debug('Received sync requeste')
@@ -317,6 +467,7 @@ Response:
   ]
 '''
 @app.route('/sync/playback/episodes')
+@cached_per_user(playback_cache)
 @required_roles()
 def sync_episodes_progress(user_token):
     app.logger.debug('Received episode sync request')
@@ -402,7 +553,7 @@ def catch_all(path):
 if __name__ == '__main__':
     app.config['SQLALCHEMY_DATABASE_URI'] = config.db_uri
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.wsgi_app = ReverseProxied(app.wsgi_app)
+    app.wsgi_app = ReverseProxied(app.wsgi_app, trusted_proxies=getattr(config, 'trusted_proxies', []))
     app.json_encoder = CustomJSONEncoder
     db.init_app(app)
     with app.app_context():
@@ -0,0 +1,117 @@
+import unittest
+
+from ratelimit import TokenBucket, RateLimiter, LoadShedder
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(rate=1/5, burst=3, now=0.)
+        self.assertEqual([bucket.consume(0.) for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.consume(0.), 5.)
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=1/5, burst=3, now=0.)
+        for i in range(3):
+            bucket.consume(0.)
+        self.assertAlmostEqual(bucket.consume(2.), 3.)
+        self.assertEqual(bucket.consume(5.), 0)
+        self.assertAlmostEqual(bucket.consume(5.), 5.)
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(rate=1, burst=2, now=0.)
+        bucket.refill(1000.)
+        self.assertEqual(bucket.tokens, 2)
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = RateLimiter({'a': (1/5, 2), 'b': (1, 1)}, max_buckets=4, clock=self.clock)
+
+    def test_retry_after(self):
+        self.assertEqual(self.limiter.hit('a', 'x'), 0)
+        self.assertEqual(self.limiter.hit('a', 'x'), 0)
+        self.assertAlmostEqual(self.limiter.hit('a', 'x'), 5.)
+        self.clock.now = 4.
+        self.assertAlmostEqual(self.limiter.hit('a', 'x'), 1.)
+        self.clock.now = 5.
+        self.assertEqual(self.limiter.hit('a', 'x'), 0)
+
+    def test_keys_and_budgets_are_independent(self):
+        self.limiter.hit('b', 'x')
+        self.assertTrue(self.limiter.hit('b', 'x'))
+        self.assertEqual(self.limiter.hit('b', 'y'), 0)
+        self.assertEqual(self.limiter.hit('a', 'x'), 0)
+
+    def test_prune_drops_refilled_buckets(self):
+        for key in 'wxyz':
+            self.limiter.hit('a', key)
+        self.clock.now = 5.
+        self.limiter.hit('a', 'v')
+        self.assertEqual(list(self.limiter.buckets), [('a', 'v')])
+
+    def test_prune_drops_least_recently_used(self):
+        for key in 'wxyz':
+            self.limiter.hit('a', key)
+            self.clock.now += 1
+        self.limiter.hit('a', 'v')
+        self.assertEqual(sorted(self.limiter.buckets), [('a', 'v'), ('a', 'y'), ('a', 'z')])
+        # The table is not scanned again until it fills up
+        self.limiter.hit('a', 'u')
+        self.assertEqual(len(self.limiter.buckets), 4)
+
+    def test_prune_keeps_active_clients_limited(self):
+        for key in 'wyz':
+            self.limiter.hit('a', key)
+        self.clock.now = .5
+        for i in range(3):
+            self.limiter.hit('a', 'x')
+        self.clock.now = 1.
+        self.limiter.hit('a', 'v')
+        self.assertIn(('a', 'x'), self.limiter.buckets)
+        self.assertTrue(self.limiter.hit('a', 'x'))
+
+class LoadShedderTest(unittest.TestCase):
+    def test_writes(self):
+        shedder = LoadShedder(max_writes=2, max_latency=1.)
+        shedder.start_write()
+        self.assertFalse(shedder.overloaded())
+        shedder.start_write()
+        self.assertTrue(shedder.overloaded())
+        shedder.end_write()
+        self.assertFalse(shedder.overloaded())
+
+    def test_latency(self):
+        shedder = LoadShedder(max_writes=2, max_latency=1., alpha=.5, clock=Clock())
+        shedder.record(3.)
+        self.assertAlmostEqual(shedder.latency, 1.5)
+        self.assertTrue(shedder.overloaded())
+        shedder.record(.5)
+        self.assertAlmostEqual(shedder.latency, 1.)
+        self.assertFalse(shedder.overloaded())
+
+    def test_latency_recovers_without_traffic(self):
+        clock = Clock()
+        shedder = LoadShedder(max_writes=2, max_latency=2., alpha=.1, half_life=5., clock=clock)
+        shedder.record(30.)
+        self.assertTrue(shedder.overloaded())
+        clock.now = 2.
+        self.assertTrue(shedder.overloaded())
+        clock.now = 5.
+        self.assertFalse(shedder.overloaded())
+
+    def test_latency_decays_between_samples(self):
+        clock = Clock()
+        shedder = LoadShedder(max_writes=2, max_latency=2., alpha=.5, half_life=5., clock=clock)
+        shedder.record(4.)
+        clock.now = 5.
+        shedder.record(0.)
+        self.assertAlmostEqual(shedder.latency, .5)
+
+if __name__ == '__main__':
+    unittest.main()
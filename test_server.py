@@ -0,0 +1,184 @@
+import importlib.util
+import os
+import sys
+import unittest
+import uuid
+
+try:
+    import flask
+    import flask_sqlalchemy
+except ImportError:
+    flask = None
+
+if flask is not None:
+    try:
+        import config
+    except ImportError:
+        # Use the sample settings when no config.py was written yet
+        spec = importlib.util.spec_from_file_location(
+            'config', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.sample.py'))
+        config = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(config)
+        sys.modules['config'] = config
+    import server
+    import invalidation
+    from models import CustomJSONEncoder
+    from sqlalchemy import event
+
+def setUpModule():
+    if flask is None:
+        raise unittest.SkipTest('Flask is not installed')
+    server.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    server.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    server.app.json_encoder = CustomJSONEncoder
+    server.db.init_app(server.app)
+    with server.app.app_context():
+        server.db.create_all()
+
+class ReverseProxiedTest(unittest.TestCase):
+    def call(self, remote_addr, forwarded_for, trusted_proxies=('10.0.0.1', '10.0.0.2')):
+        environ = {'REMOTE_ADDR': remote_addr, 'PATH_INFO': '/prefix/path',
+                   'HTTP_X_SCRIPT_NAME': '/prefix', 'HTTP_X_FORWARDED_FOR': forwarded_for}
+        seen = {}
+        def app(environ, start_response):
+            seen.update(environ)
+            return []
+        server.ReverseProxied(app, trusted_proxies=trusted_proxies)(environ, None)
+        return seen
+
+    def test_untrusted_forwarded_for_ignored(self):
+        with self.assertLogs(server.app.logger, 'WARNING'):
+            environ = self.call('6.6.6.6', '1.1.1.1')
+        self.assertEqual(environ['REMOTE_ADDR'], '6.6.6.6')
+        self.assertEqual((environ['SCRIPT_NAME'], environ['PATH_INFO']), ('/prefix', '/path'))
+
+    def test_trusted_proxy(self):
+        self.assertEqual(self.call('10.0.0.1', '1.1.1.1')['REMOTE_ADDR'], '1.1.1.1')
+
+    def test_client_is_last_untrusted_address(self):
+        environ = self.call('10.0.0.1', '9.9.9.9, 1.1.1.1, 10.0.0.2')
+        self.assertEqual(environ['REMOTE_ADDR'], '1.1.1.1')
+
+    def test_only_trusted_proxies(self):
+        self.assertEqual(self.call('10.0.0.1', '10.0.0.2')['REMOTE_ADDR'], '10.0.0.2')
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        # Stop time so buckets don't refill during the test
+        clock = server.limiter.clock
+        self.addCleanup(setattr, server.limiter, 'clock', clock)
+        server.limiter.clock = lambda: 0.
+        server.limiter.buckets.clear()
+        server.shedder.writes = 0
+        server.shedder.latency = 0.
+        server.bus.dispatch(invalidation.ALL, None)
+        self.client = server.app.test_client()
+
+    def request(self, method, path, address='1.2.3.4', token=None, **kwargs):
+        headers = {'Authorization': 'Bearer ' + token} if token else {}
+        return self.client.open(path, method=method, headers=headers,
+                                environ_base={'REMOTE_ADDR': address}, **kwargs)
+
+    def statuses(self, count, *args, **kwargs):
+        return [self.request(*args, **kwargs).status_code for i in range(count)]
+
+class AdmissionTest(ServerTestCase):
+    def test_retry_after(self):
+        self.assertNotIn(429, self.statuses(5, 'POST', '/oauth/device/code'))
+        response = self.request('POST', '/oauth/device/code')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '10')
+
+    def test_budgets_per_endpoint(self):
+        self.statuses(6, 'POST', '/oauth/device/code')
+        self.assertNotEqual(self.request('GET', '/sync/ratings/movies').status_code, 429)
+        self.assertEqual(self.request('POST', '/oauth/device/code', address='1.2.3.5').status_code, 200)
+
+    def test_address_budget(self):
+        statuses = [self.request('GET', '/sync/ratings/movies', token=str(uuid.uuid4())).status_code
+                    for i in range(51)]
+        self.assertNotIn(429, statuses[:50])
+        self.assertEqual(statuses[50], 429)
+
+    def test_keyed_by_token(self):
+        first, second = str(uuid.uuid4()), str(uuid.uuid4())
+        self.assertNotIn(429, self.statuses(10, 'POST', '/scrobble/stop', token=first))
+        self.assertNotIn(429, self.statuses(10, 'POST', '/scrobble/stop', token=second))
+        self.assertEqual(self.request('POST', '/scrobble/stop', token=first).status_code, 429)
+
+    def test_malformed_token_keyed_by_address(self):
+        statuses = [self.request('POST', '/scrobble/stop', token='bogus%d' % i).status_code for i in range(11)]
+        self.assertEqual(statuses[10], 429)
+
+    def test_catch_all_keyed_by_address(self):
+        statuses = [self.request('GET', '/unknown', token=str(uuid.uuid4())).status_code for i in range(6)]
+        self.assertEqual(statuses[5], 429)
+
+    def test_client_key(self):
+        token, code = str(uuid.uuid4()), str(uuid.uuid4())
+        with server.app.test_request_context('/sync/watched/shows', headers={'Authorization': 'Bearer ' + token}):
+            self.assertEqual(server.client_key('ip:a'), 'token:' + token)
+        with server.app.test_request_context('/register', method='POST', headers={'Authorization': 'Bearer ' + token}):
+            self.assertEqual(server.client_key('ip:a'), 'ip:a')
+        with server.app.test_request_context('/oauth/device/token', method='POST', json={'code': code}):
+            self.assertEqual(server.client_key('ip:a'), 'code:' + code)
+        with server.app.test_request_context('/oauth/device/token', method='POST', json={'code': 'bogus'}):
+            self.assertEqual(server.client_key('ip:a'), 'ip:a')
+        with server.app.test_request_context('/oauth/device/token', method='POST', json=[code]):
+            self.assertEqual(server.client_key('ip:a'), 'ip:a')
+
+    def test_shedding(self):
+        server.shedder.writes = server.shedder.max_writes
+        response = self.request('GET', '/sync/ratings/movies')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        server.shedder.writes = 0
+        self.assertNotEqual(self.request('GET', '/sync/ratings/movies').status_code, 503)
+
+class CacheCoherenceTest(ServerTestCase):
+    def scrobble(self, token, tvdb):
+        # Unique ids are shared by all users, use new ones for each test
+        episode = {
+            'show': {'ids': {'tvdb': str(tvdb)}, 'title': 'Scrubs', 'year': 2001},
+            'episode': {'ids': {'tvdb': {'tvdb': str(tvdb + 1)}}, 'number': 3, 'season': 3, 'title': 'My White Whale'},
+            'progress': 100,
+        }
+        self.assertEqual(self.request('POST', '/scrobble/stop', token=token, json=episode).status_code, 200)
+
+    def authorize(self, username):
+        code = self.request('POST', '/oauth/device/code').get_json()
+        self.request('POST', '/register', data={'user_code': code['user_code'], 'username': username})
+        token = self.request('POST', '/oauth/device/token', json={'code': code['device_code']}).get_json()
+        return code['user_code'], token['access_token']
+
+    def test_scrobble_invalidates_sync(self):
+        user_code, token = self.authorize('scrobbler')
+        self.assertEqual(self.request('GET', '/sync/watched/shows', token=token).get_json(), [])
+        self.scrobble(token, 1000)
+        self.assertEqual(len(self.request('GET', '/sync/watched/shows', token=token).get_json()), 1)
+
+    def test_register_again_invalidates_token(self):
+        user_code, token = self.authorize('alice')
+        self.scrobble(token, 2000)
+        self.assertEqual(len(self.request('GET', '/sync/watched/shows', token=token).get_json()), 1)
+        self.request('POST', '/register', data={'user_code': user_code, 'username': 'bob'})
+        self.assertEqual(self.request('GET', '/sync/watched/shows', token=token).get_json(), [])
+
+    def test_invalidation_during_token_lookup(self):
+        user_code, token = self.authorize('carol')
+        with server.app.app_context():
+            engine = server.db.engine
+        published = []
+        def renewed_meanwhile(*args):
+            if not published:
+                published.append(token)
+                server.bus.publish('token', token)
+        event.listen(engine, 'before_cursor_execute', renewed_meanwhile)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', renewed_meanwhile)
+        self.assertEqual(self.request('GET', '/sync/watched/shows', token=token).status_code, 200)
+        self.assertIsNone(server.token_cache.get(token))
+        self.request('GET', '/sync/watched/shows', token=token)
+        self.assertIsNotNone(server.token_cache.get(token))
+
+if __name__ == '__main__':
+    unittest.main()